@@ -1,7 +1,8 @@
 """Config file for ZeroShotEval launcher scripts
 
-This module contains config settings for all modules in ZeroShotEval toolkit 
-in the format of easydict dictionaries.
+This module contains config settings for all modules in ZeroShotEval toolkit.
+Launcher settings are stored in the easydict dictionary `config`, while model
+and dataset configs are frozen dataclasses built once at import.
 
 
 Already contains the following configs:
@@ -21,9 +22,91 @@ Datasets:
 #     * etc.
 
 
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Mapping, Tuple
+
 from easydict import EasyDict as edict
 
 
+#region CONFIG STRUCTURES
+@dataclass(frozen=True)
+class GeneralHyperCfg:
+    """General hyperparameters for all models."""
+    device: str = "cpu"
+    num_shots: int = 0
+    generalized: bool = True
+    batch_size: int = 32
+    nepoch: int = 100
+    fp16_train_mode: bool = False  # for GPUs with tensor cores
+    compile_train_step: bool = False  # CUDA only, requires torch.compile (PyTorch 2.0+)
+    encoder_streams: bool = False  # CUDA eager mode only, encodes modalities on separate streams
+
+
+@dataclass(frozen=True)
+class WarmupTermCfg:
+    """Linear warmup of a loss term factor from `start_epoch` to `end_epoch`."""
+    factor: float
+    end_epoch: int
+    start_epoch: int
+
+
+@dataclass(frozen=True)
+class CadaVaeWarmupCfg:
+    beta: WarmupTermCfg
+    cross_reconstruction: WarmupTermCfg
+    distance: WarmupTermCfg
+
+
+@dataclass(frozen=True)
+class CadaVaeParametersCfg:
+    lr_gen_model: float
+    loss: str
+    latent_size: int
+    lr_cls: float
+    cls_train_epochs: int
+    auxiliary_data_source: str
+    hidden_layers: Mapping[str, Tuple[int, ...]]
+    input_features_from_cnn: int
+    hidden_size_rule: Mapping[str, Tuple[int, ...]]
+    warmup: CadaVaeWarmupCfg
+    cls_train_steps: int
+
+
+@dataclass(frozen=True)
+class CadaVaeCfg:
+    model_name: str
+    cross_resonstuction: bool
+    distance: str
+    specific_parameters: CadaVaeParametersCfg
+
+
+@dataclass(frozen=True)
+class ClswganCfg:
+    model_name: str
+
+
+@dataclass(frozen=True)
+class EmbeddingCfg:
+    module_name: str = ""
+    class_name: str = ""
+    have_pretrained: bool = True
+    path: str = ""
+
+
+@dataclass(frozen=True)
+class DatasetCfg:
+    dataset_name: str
+    path: str = ""
+    precomputed_embeddings_path: str = ""
+    num_classes: int = 0
+    num_novel_classes: int = 0
+    samples_per_class: Tuple[int, ...] = ()
+    class_embedding: Mapping[str, EmbeddingCfg] = field(default_factory=lambda: MappingProxyType({}))
+    object_embedding: Mapping[str, EmbeddingCfg] = field(default_factory=lambda: MappingProxyType({}))
+#endregion
+
+
 #region GLOBAL DEFAULT CONFIGS
 config = edict()
 
@@ -36,6 +119,9 @@ config.load_dataset_precomputed_embeddings = True
 config.load_cached_obj_embeddings = False
 config.cache_obj_embeddings = True  # recommended always True
 
+config.cache_zsl_embeddings = False
+config.zsl_embeddings_cache_dir = 'data/cache/'
+
 config.model = 'cada_vae'
 config.datasets = ['cub']
 #endregion
@@ -44,70 +130,51 @@ config.datasets = ['cub']
 #region MODEL CONFIGS
 model = edict()
 
-model.general_hyper = edict()  # general hyper for all models
-model.general_hyper.device = "cpu"
-model.general_hyper.num_shots = 0
-model.general_hyper.generalized = True
-model.general_hyper.batch_size = 32
-model.general_hyper.nepoch = 100
-model.general_hyper.fp16_train_mode = False  # for GPUs with tensor cores
+model.general_hyper = GeneralHyperCfg()  # general hyper for all models
 
 
 #region CADA_VAE CONFIGS
-model.cada_vae = edict()
-model.cada_vae.model_name = "cada_vae"
-# model.CADA_VAE.class_name = "CADA_VAE"
-model.cada_vae.cross_resonstuction = True
-model.cada_vae.distance = "wasserstein"
-
-model.cada_vae.specific_parameters = edict()
-model.cada_vae.specific_parameters.lr_gen_model = 0.00015
-model.cada_vae.specific_parameters.loss = 'l1'
-model.cada_vae.specific_parameters.latent_size = 64
-model.cada_vae.specific_parameters.lr_cls = 0.001
-model.cada_vae.specific_parameters.cls_train_epochs = 100  # early stopping nepoch стоит изменить
-model.cada_vae.specific_parameters.auxiliary_data_source = 'attributes'  # для общности следует переделать эту и связанные части
-
-
-# NOTE: эти парамертры стоит извлекать из генераторов эмбедингов/кэшированных эмбедингов.
-# Их нужно перенести в dataset или куда-то ещё. 
-# 
-# Стоит ли развести скрытые слои для декодера/энкодера?
-
-
-model.cada_vae.specific_parameters.hidden_layers = edict()
-model.cada_vae.specific_parameters.hidden_layers.cnn_features = (1560, 1660)
-model.cada_vae.specific_parameters.hidden_layers.attributes = (1450, 665)
-model.cada_vae.specific_parameters.hidden_layers.sentences = (1450, 665)
-model.cada_vae.specific_parameters.input_features_from_cnn = 2048  # for ResNet101
-
-model.cada_vae.specific_parameters.hidden_size_rule = edict()
-model.cada_vae.specific_parameters.hidden_size_rule.resnet_features = (1560, 1660)
-model.cada_vae.specific_parameters.hidden_size_rule.attributes = (1450, 665)
-model.cada_vae.specific_parameters.hidden_size_rule.sentences = (1450, 665)
-
-model.cada_vae.specific_parameters.warmup = edict()
-model.cada_vae.specific_parameters.warmup.beta = edict()
-model.cada_vae.specific_parameters.warmup.beta.factor = 0.25
-model.cada_vae.specific_parameters.warmup.beta.end_epoch = 93
-model.cada_vae.specific_parameters.warmup.beta.start_epoch = 0
-
-model.cada_vae.specific_parameters.warmup.cross_reconstruction = edict()
-model.cada_vae.specific_parameters.warmup.cross_reconstruction.factor = 2.37
-model.cada_vae.specific_parameters.warmup.cross_reconstruction.end_epoch = 75
-model.cada_vae.specific_parameters.warmup.cross_reconstruction.start_epoch = 21
-
-model.cada_vae.specific_parameters.warmup.distance = edict()
-model.cada_vae.specific_parameters.warmup.distance.factor = 8.13
-model.cada_vae.specific_parameters.warmup.distance.end_epoch = 22
-model.cada_vae.specific_parameters.warmup.distance.start_epoch = 6
-
-model.cada_vae.specific_parameters.cls_train_steps = 29  # TODO: transfer auto selection from original repo
+model.cada_vae = CadaVaeCfg(
+    model_name="cada_vae",
+    # class_name = "CADA_VAE",
+    cross_resonstuction=True,
+    distance="wasserstein",
+    specific_parameters=CadaVaeParametersCfg(
+        lr_gen_model=0.00015,
+        loss='l1',
+        latent_size=64,
+        lr_cls=0.001,
+        cls_train_epochs=100,  # early stopping nepoch стоит изменить
+        auxiliary_data_source='attributes',  # для общности следует переделать эту и связанные части
+
+        # NOTE: эти парамертры стоит извлекать из генераторов эмбедингов/кэшированных эмбедингов.
+        # Их нужно перенести в dataset или куда-то ещё.
+        #
+        # Стоит ли развести скрытые слои для декодера/энкодера?
+
+        hidden_layers=MappingProxyType({
+            'cnn_features': (1560, 1660),
+            'attributes': (1450, 665),
+            'sentences': (1450, 665),
+        }),
+        input_features_from_cnn=2048,  # for ResNet101
+        hidden_size_rule=MappingProxyType({
+            'resnet_features': (1560, 1660),
+            'attributes': (1450, 665),
+            'sentences': (1450, 665),
+        }),
+        warmup=CadaVaeWarmupCfg(
+            beta=WarmupTermCfg(factor=0.25, end_epoch=93, start_epoch=0),
+            cross_reconstruction=WarmupTermCfg(factor=2.37, end_epoch=75, start_epoch=21),
+            distance=WarmupTermCfg(factor=8.13, end_epoch=22, start_epoch=6),
+        ),
+        cls_train_steps=29,  # TODO: transfer auto selection from original repo
+    ),
+)
 #endregion
 
 #region CLSWGAN CONFIGS
-model.clswgan = edict()
-model.clswgan.model_name = 'clswgan'
+model.clswgan = ClswganCfg(model_name='clswgan')
 # TODO: complete CLSWGAN CONFIGS section
 #endregion
 
@@ -118,37 +185,25 @@ model.clswgan.model_name = 'clswgan'
 dataset = edict()
 
 #region CUB DATASET CONFIGS
-dataset.cub = edict()
-dataset.cub.dataset_name = 'cub'
-dataset.cub.path = "data/CUB_200_2011/"
-dataset.cub.precomputed_embeddings_path = 'data/CUB/res101.mat'
-
-dataset.cub.num_classes = 200
-dataset.cub.num_novel_classes = 50
-dataset.cub.samples_per_class = (200, 0, 400, 0) # ! Будет меняться от generalized (num_shots == 0). Данные значение для GZSL
-# TODO: Стоит изменть для общности предыдущую строку
-
-dataset.cub.class_embedding = edict()
-
-dataset.cub.class_embedding.description_emb = edict()
-dataset.cub.class_embedding.description_emb.module_name = ""
-dataset.cub.class_embedding.description_emb.class_name = ""
-dataset.cub.class_embedding.description_emb.have_pretrained = True
-dataset.cub.class_embedding.description_emb.path = ""
-
-dataset.cub.object_embedding = edict()
-
-dataset.cub.object_embedding.resnet101 = edict()
-
-dataset.cub.object_embedding.resnet101.module_name = ""
-dataset.cub.object_embedding.resnet101.class_name = ""
-dataset.cub.object_embedding.resnet101.have_pretrained = True
-dataset.cub.object_embedding.resnet101.path = ""
+dataset.cub = DatasetCfg(
+    dataset_name='cub',
+    path="data/CUB_200_2011/",
+    precomputed_embeddings_path='data/CUB/res101.mat',
+    num_classes=200,
+    num_novel_classes=50,
+    samples_per_class=(200, 0, 400, 0),  # ! Будет меняться от generalized (num_shots == 0). Данные значение для GZSL
+    # TODO: Стоит изменть для общности предыдущую строку
+    class_embedding=MappingProxyType({
+        'description_emb': EmbeddingCfg(module_name="", class_name="", have_pretrained=True, path=""),
+    }),
+    object_embedding=MappingProxyType({
+        'resnet101': EmbeddingCfg(module_name="", class_name="", have_pretrained=True, path=""),
+    }),
+)
 #endregion
 
 #region AWA2 DATASET CONFIGS
-dataset.awa2 = edict()
-dataset.awa2.dataset_name = "awa2"
+dataset.awa2 = DatasetCfg(dataset_name="awa2")
 # TODO: complete AWA2 DATASET CONFIGS section
 #endregion 
 
@@ -166,15 +221,15 @@ default.object_embedding = "resnet101"
 
 
 def generate_config(parsed_model, parsed_datasets):
-    for key, value in model[parsed_model].items():
-        config[key] = value
-    for key, value in dataset[parsed_datasets].items():
-        config[key] = value
-    # for _dataset in parsed_datasets:
-    #     config[_dataset] = edict()
-    #     for key, value in dataset[_dataset].items():
-    #         config[_dataset][key] = value
-    for key, value in model.general_hyper.items():
-        config[key] = value
+    """Attach the selected model, datasets and general configs to the launcher config.
+
+    The frozen configs are passed by reference instead of being merged into `config`,
+    so repeated calls never modify the module-level model and dataset configs.
+    """
+    if isinstance(parsed_datasets, str):
+        parsed_datasets = [parsed_datasets]
+    config.general_parameters = model.general_hyper
+    config.model_parameters = model[parsed_model]
+    config.datasets_parameters = tuple(dataset[_dataset] for _dataset in parsed_datasets)
     config.model = parsed_model
-    config.datasets = parsed_datasets
+    config.datasets = list(parsed_datasets)
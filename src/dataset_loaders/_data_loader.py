@@ -9,9 +9,13 @@ import pickle
 import copy
 
 def map_label(label, classes):
-    mapped_label = torch.LongTensor(label.size())
-    for i in range(classes.size(0)):
-        mapped_label[label==classes[i]] = i
+    # lookup table from class id to its index in classes, built on the labels device
+    max_class = int(classes.max())
+    assert int(label.min()) >= 0 and int(label.max()) <= max_class, 'Some labels are not present in classes'
+    lut = torch.full((max_class + 1,), -1, dtype=torch.long, device=classes.device)
+    lut[classes.long()] = torch.arange(classes.size(0), device=classes.device)
+    mapped_label = lut[label.long()]
+    assert bool((mapped_label >= 0).all()), 'Some labels are not present in classes'
 
     return mapped_label
 
@@ -68,22 +72,23 @@ class DATA_LOADER(object):
 
     def gen_next_batch(self, batch_size, dset_part='train'):
         if dset_part == 'train':
-            features = self.data['train_seen']['resnet_features']
-            labels = self.data['train_seen']['labels']
+            split = self.data['train_seen']
         elif dset_part == 'test':
-            features = self.data['test_unseen']['resnet_features']
-            labels = self.data['test_unseen']['labels']
+            split = self.data['test_unseen']
         else:
             raise ValueError('Dataset part is not valid, please specify train or test.')
 
-        iter_len = len(features) // batch_size + 1
-        for current_batch in range(iter_len):
-            current_idx = current_batch * batch_size
+        features = split['resnet_features']
+        labels = split['labels']
+        # per-sample auxiliary data is precomputed at load time
+        attrs = split[self.auxiliary_data_source]
+
+        for current_idx in range(0, len(features), batch_size):
             end_idx = current_idx + batch_size
 
             batch_features = features[current_idx:end_idx]
             batch_label = labels[current_idx:end_idx]
-            batch_attr = self.aux_data[batch_label]
+            batch_attr = attrs[current_idx:end_idx]
 
             yield batch_label, [batch_features, batch_attr]
 
@@ -136,8 +141,8 @@ class DATA_LOADER(object):
         test_unseen_label = torch.from_numpy(label[test_unseen_loc]).long().to(self.device)
         test_seen_label = torch.from_numpy(label[test_seen_loc]).long().to(self.device)
 
-        self.seenclasses = torch.from_numpy(np.unique(train_label.cpu().numpy())).to(self.device)
-        self.novelclasses = torch.from_numpy(np.unique(test_unseen_label.cpu().numpy())).to(self.device)
+        self.seenclasses = torch.unique(train_label)
+        self.novelclasses = torch.unique(test_unseen_label)
         self.ntrain = train_feature.size()[0]
         self.ntrain_class = self.seenclasses.size(0)
         self.ntest_class = self.novelclasses.size(0)
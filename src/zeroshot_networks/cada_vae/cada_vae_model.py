@@ -3,45 +3,107 @@
 
 # region IMPORTS
 import copy
+import functools
+import hashlib
+from pathlib import Path
+import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 import torch.autograd as autograd
-from torch.utils import data
 from src.zeroshot_networks.cada_vae.vae_networks import EncoderTemplate, DecoderTemplate
 from src.dataset_loaders._data_loader import DATA_LOADER as dataloader
 # endregion
 
 
+def loss_factors(epoch, warmup):
+    """Compute loss scale factors for the given epoch according to the warmup schedule.
+
+    Each factor grows linearly from 0 at ``start_epoch`` up to ``factor`` at ``end_epoch``.
+
+    Returns:
+        Tuple of (beta, cross_reconstruction_factor, distance_factor).
+    """
+    factors = []
+    for term in (warmup.beta, warmup.cross_reconstruction, warmup.distance):
+        f = 1.0 * (epoch - term.start_epoch) / (1.0 * (term.end_epoch - term.start_epoch))
+        f = f * (1.0 * term.factor)
+        factors.append(min(max(f, 0), term.factor))
+    return tuple(factors)
+
+
+def precompute_loss_schedule(nepoch, warmup):
+    """Precompute loss scale factors for all epochs of a training run.
+
+    Returns:
+        Array of shape (nepoch, 3) with (beta, cross_reconstruction_factor, distance_factor)
+        for each epoch.
+    """
+    return np.array([loss_factors(epoch, warmup) for epoch in range(nepoch)],
+                    dtype=np.float64).reshape(nepoch, 3)
+
+
+def distribution_alignment(mu, logvar):
+    """Wasserstein-2 distance between latent distributions of all modality pairs.
+
+    Args:
+        mu: stacked latent means of shape (num_modalities, batch_size, latent_size).
+        logvar: stacked latent log-variances of the same shape.
+
+    Returns:
+        Sum of per-sample distances over the batch and all modality pairs.
+    """
+    # distance over means and standard deviations is a single norm of the concatenated difference
+    mu_sigma = torch.cat((mu, (logvar / 2).exp()), dim=-1)
+    # gather pairs first so that zero distances of the diagonal never reach the norm
+    i, j = torch.triu_indices(mu.size(0), mu.size(0), offset=1, device=mu.device)
+    distance = torch.linalg.vector_norm(mu_sigma[i] - mu_sigma[j], ord=2, dim=-1)
+    return distance.sum()
+
+
 class Model(nn.Module):
     def __init__(self, config):
         super(Model, self).__init__()
 
         # region HYPERPARAMETERS ASSIGNMENT
-        self.device = config.device
-        self.auxiliary_data_source = config.specific_parameters.auxiliary_data_source
+        general_parameters = config.general_parameters
+        specific_parameters = config.model_parameters.specific_parameters
+        dataset_parameters = config.datasets_parameters[0]  # TODO: integrate multiple datasets support
+
+        self.device = general_parameters.device
+        self.auxiliary_data_source = specific_parameters.auxiliary_data_source
         self.all_data_sources = ['resnet_features', self.auxiliary_data_source]
-        self.dataset = config.dataset_name
+        self.dataset = dataset_parameters.dataset_name
         # for Few-Shot Learning only, else equals 0
-        self.num_shots = config.num_shots
-        self.latent_size = config.specific_parameters.latent_size
-        self.batch_size = config.batch_size
-        self.hidden_size_rule = config.specific_parameters.hidden_size_rule
-        self.warmup = config.specific_parameters.warmup
+        self.num_shots = general_parameters.num_shots
+        self.latent_size = specific_parameters.latent_size
+        self.batch_size = general_parameters.batch_size
+        self.hidden_size_rule = specific_parameters.hidden_size_rule
+        self.warmup = specific_parameters.warmup
         # boolean param for GZSL
-        self.generalized = config.generalized
+        self.generalized = general_parameters.generalized
         self.classifier_batch_size = 32
-        self.img_seen_samples = config.samples_per_class[0]  # TODO: integrate multiple datasets support
-        self.att_seen_samples = config.samples_per_class[1]
-        self.att_unseen_samples = config.samples_per_class[2]
-        self.img_unseen_samples = config.samples_per_class[3]
-        self.reco_loss_function = config.specific_parameters.loss
-        self.nepoch = config.nepoch
-        self.lr_cls = config.specific_parameters.lr_cls
-        self.cross_reconstruction = config.specific_parameters.warmup.cross_reconstruction
-        self.cls_train_epochs = config.specific_parameters.cls_train_steps
+        self.img_seen_samples = dataset_parameters.samples_per_class[0]
+        self.att_seen_samples = dataset_parameters.samples_per_class[1]
+        self.att_unseen_samples = dataset_parameters.samples_per_class[2]
+        self.img_unseen_samples = dataset_parameters.samples_per_class[3]
+        self.reco_loss_function = specific_parameters.loss
+        self.nepoch = general_parameters.nepoch
+        self.compile_train_step = general_parameters.compile_train_step
+        self.use_encoder_streams = general_parameters.encoder_streams
+        self.fp16_train_mode = general_parameters.fp16_train_mode
+        self.device_type = torch.device(self.device).type
+        self.cache_zsl_embeddings = config.cache_zsl_embeddings
+        self.zsl_embeddings_cache_dir = config.zsl_embeddings_cache_dir
+        self.zsl_embeddings_cache_key = None
+        self.encoder_streams = None
+        # latents are sampled with noise during training only
+        self.reparameterize_with_noise = False
+        self.lr_cls = specific_parameters.lr_cls
+        self.cross_reconstruction = specific_parameters.warmup.cross_reconstruction
+        self.cls_train_epochs = specific_parameters.cls_train_steps
         # endregion
 
         # region DATASET LOADING
@@ -80,176 +142,274 @@ class Model(nn.Module):
             parameters_to_optimize += list(self.encoder[datatype].parameters())
             parameters_to_optimize += list(self.decoder[datatype].parameters())
 
-        self.optimizer = optim.Adam(parameters_to_optimize, lr=config.specific_parameters.lr_gen_model, betas=(
+        self.optimizer = optim.Adam(parameters_to_optimize, lr=specific_parameters.lr_gen_model, betas=(
             0.9, 0.999), eps=1e-08, weight_decay=0, amsgrad=True)
 
+        # the loss function is selected once here and called directly in compute_losses
         if self.reco_loss_function == 'l2':
-            self.reconstruction_criterion = nn.MSELoss(size_average=False)
+            self.reconstruction_criterion = functools.partial(F.mse_loss, reduction='sum')
 
         elif self.reco_loss_function == 'l1':
-            self.reconstruction_criterion = nn.L1Loss(size_average=False)
+            self.reconstruction_criterion = functools.partial(F.l1_loss, reduction='sum')
+
+        else:
+            raise ValueError('Reconstruction loss is not valid, please specify l1 or l2.')
+
+        # mixed precision: float16 on tensor-core GPUs, bfloat16 for CPU autocast
+        self.amp_dtype = torch.float16 if self.device_type == 'cuda' else torch.bfloat16
+        # loss scaling is required for float16 gradients only
+        self.scaler = torch.amp.GradScaler(
+            self.device_type, enabled=self.fp16_train_mode and self.amp_dtype == torch.float16)
 
     def reparameterize(self, mu, logvar):
         if self.reparameterize_with_noise:
             sigma = torch.exp(logvar)
-            eps = torch.FloatTensor(logvar.size()[0],1).normal_(0,1)
-            eps  = eps.expand(sigma.size())
+            eps = torch.randn(logvar.size(0), 1, dtype=logvar.dtype, device=logvar.device)
+            eps = eps.expand(sigma.size())
             return mu + sigma*eps
         else:
             return mu
 
-    def trainstep(self, img, att):
+    def encode(self, inputs):
+        """Encode inputs of all modalities, each on its own CUDA stream when available.
+
+        Args:
+            inputs: dict of input features by modality.
+
+        Returns:
+            Dict of (mu, logvar) tuples by modality.
+        """
+        if self.encoder_streams is None:
+            return {datatype: self.encoder[datatype](x) for datatype, x in inputs.items()}
+
+        # modality encoders are independent, so their forwards overlap on side streams
+        current_stream = torch.cuda.current_stream(self.device)
+        outputs = {}
+        for datatype, x in inputs.items():
+            stream = self.encoder_streams[datatype]
+            stream.wait_stream(current_stream)
+            with torch.cuda.stream(stream):
+                outputs[datatype] = self.encoder[datatype](x)
+        for stream in self.encoder_streams.values():
+            current_stream.wait_stream(stream)
+        return outputs
+
+    def compute_losses(self, img, att, with_cross_reconstruction=True, with_distance=True):
+        """Forward pass of all encoders and decoders with unscaled loss terms.
+
+        Cross reconstruction and distribution alignment are skipped (returned as zeros)
+        when disabled, e.g. while their warmup factor is still 0.
+
+        Returns:
+            Tuple of (reconstruction_loss, KLD, cross_reconstruction_loss, distance).
+        """
+        aux = self.auxiliary_data_source
+        criterion = self.reconstruction_criterion
 
         ##############################################
         # Encode image features and additional
         # features
         ##############################################
 
-        mu_img, logvar_img = self.encoder['resnet_features'](img)
+        latents = self.encode({'resnet_features': img, aux: att})
+
+        mu_img, logvar_img = latents['resnet_features']
         z_from_img = self.reparameterize(mu_img, logvar_img)
 
-        mu_att, logvar_att = self.encoder[self.auxiliary_data_source](att)
+        mu_att, logvar_att = latents[aux]
         z_from_att = self.reparameterize(mu_att, logvar_att)
 
         ##############################################
-        # Reconstruct inputs
+        # Reconstruct inputs from own and cross latents:
+        # each decoder runs once on the concatenated batch
         ##############################################
 
-        img_from_img = self.decoder['resnet_features'](z_from_img)
-        att_from_att = self.decoder[self.auxiliary_data_source](z_from_att)
+        if with_cross_reconstruction:
+            batch_size = img.size(0)
+            img_from_img, img_from_att = torch.split(
+                self.decoder['resnet_features'](torch.cat((z_from_img, z_from_att))), batch_size)
+            att_from_att, att_from_img = torch.split(
+                self.decoder[aux](torch.cat((z_from_att, z_from_img))), batch_size)
+        else:
+            img_from_img = self.decoder['resnet_features'](z_from_img)
+            att_from_att = self.decoder[aux](z_from_att)
 
-        reconstruction_loss = self.reconstruction_criterion(img_from_img, img) \
-                              + self.reconstruction_criterion(att_from_att, att)
+        reconstruction_loss = criterion(img_from_img, img) + criterion(att_from_att, att)
 
         ##############################################
         # Cross Reconstruction Loss
         ##############################################
-        img_from_att = self.decoder['resnet_features'](z_from_att)
-        att_from_img = self.decoder[self.auxiliary_data_source](z_from_img)
 
-        cross_reconstruction_loss = self.reconstruction_criterion(img_from_att, img) \
-                                    + self.reconstruction_criterion(att_from_img, att)
+        if with_cross_reconstruction:
+            cross_reconstruction_loss = criterion(img_from_att, img) + criterion(att_from_img, att)
+        else:
+            cross_reconstruction_loss = reconstruction_loss.new_zeros(())
 
         ##############################################
         # KL-Divergence
         ##############################################
 
-        KLD = (0.5 * torch.sum(1 + logvar_att - mu_att.pow(2) - logvar_att.exp())) \
-              + (0.5 * torch.sum(1 + logvar_img - mu_img.pow(2) - logvar_img.exp()))
+        # latents of all modalities share the same shape, so KLD is computed in one pass;
+        # keep KLD and distribution alignment in float32 to avoid overflow of logvar.exp()
+        mu = torch.stack((mu_img, mu_att)).float()
+        logvar = torch.stack((logvar_img, logvar_att)).float()
+
+        KLD = 0.5 * torch.sum(1 + logvar - mu.pow(2) - logvar.exp())
 
         ##############################################
         # Distribution Alignment
         ##############################################
-        distance = torch.sqrt(torch.sum((mu_img - mu_att) ** 2, dim=1) + \
-                              torch.sum((torch.sqrt(logvar_img.exp()) - torch.sqrt(logvar_att.exp())) ** 2, dim=1))
+        if with_distance:
+            distance = distribution_alignment(mu, logvar)
+        else:
+            distance = KLD.new_zeros(())
+
+        return reconstruction_loss, KLD, cross_reconstruction_loss, distance
 
-        distance = distance.sum()
+    def trainstep(self, img, att):
 
         ##############################################
         # scale the loss terms according to the warmup
-        # schedule
+        # schedule, terms with zero factor are not computed
         ##############################################
 
-        f1 = 1.0*(self.current_epoch - self.warmup.cross_reconstruction.start_epoch)/(1.0*( self.warmup.cross_reconstruction.end_epoch- self.warmup.cross_reconstruction.start_epoch))
-        f1 = f1*(1.0*self.warmup.cross_reconstruction.factor)
-        cross_reconstruction_factor = torch.FloatTensor([min(max(f1,0),self.warmup.cross_reconstruction.factor)])
+        beta, cross_reconstruction_factor, distance_factor = self.current_loss_factors
 
-        f2 = 1.0 * (self.current_epoch - self.warmup.beta.start_epoch) / ( 1.0 * (self.warmup.beta.end_epoch - self.warmup.beta.start_epoch))
-        f2 = f2 * (1.0 * self.warmup.beta.factor)
-        beta = torch.FloatTensor([min(max(f2, 0), self.warmup.beta.factor)])
-
-        f3 = 1.0*(self.current_epoch - self.warmup.distance.start_epoch )/(1.0*( self.warmup.distance.end_epoch- self.warmup.distance.start_epoch))
-        f3 = f3*(1.0*self.warmup.distance.factor)
-        distance_factor = torch.FloatTensor([min(max(f3,0),self.warmup.distance.factor)])
+        with torch.autocast(device_type=self.device_type, dtype=self.amp_dtype,
+                            enabled=self.fp16_train_mode):
+            reconstruction_loss, KLD, cross_reconstruction_loss, distance = self.compute_losses_fn(
+                img, att, cross_reconstruction_factor > 0, distance_factor > 0)
 
         ##############################################
         # Put the loss together and call the optimizer
         ##############################################
 
-        self.optimizer.zero_grad()
+        self.optimizer.zero_grad(set_to_none=True)
 
         loss = reconstruction_loss - beta * KLD
 
-        if cross_reconstruction_loss>0:
+        if cross_reconstruction_factor > 0:
             loss += cross_reconstruction_factor*cross_reconstruction_loss
         if distance_factor >0:
             loss += distance_factor*distance
 
-        loss.backward()
+        self.scaler.scale(loss).backward()
 
-        self.optimizer.step()
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
 
-        return loss.item()
+        # keep the loss on device, synchronizing here would stall the next step
+        return loss.detach()
 
     def train_vae(self):
         losses = []
 
-        self.dataloader = data.DataLoader(
-            self.dataset, batch_size=self.batch_size, shuffle=True, drop_last=True)  # ,num_workers = 4)
-
         self.dataset.novelclasses = self.dataset.novelclasses.long()
         self.dataset.seenclasses = self.dataset.seenclasses.long()
         # leave both statements
         self.train()
         self.reparameterize_with_noise = True
+        # weights are about to change, the cached embeddings key is recomputed on next predict
+        self.zsl_embeddings_cache_key = None
+
+        # capture forward and losses into a compiled graph to cut the eager-mode
+        # overhead around the small encoder/decoder networks; CUDA graphs of
+        # 'reduce-overhead' mode do not apply on CPU, where eager mode is as fast
+        self.compute_losses_fn = self.compute_losses
+        self.encoder_streams = None
+        if self.compile_train_step and self.device_type == 'cuda' and hasattr(torch, 'compile'):
+            self.compute_losses_fn = torch.compile(self.compute_losses, mode='reduce-overhead')
+        elif self.use_encoder_streams and self.device_type == 'cuda':
+            # in eager mode optionally run modality encoders on separate streams,
+            # a compiled graph is scheduled by the compiler itself
+            self.encoder_streams = {datatype: torch.cuda.Stream(device=self.device)
+                                    for datatype in self.all_data_sources}
+
+        loss_schedule = precompute_loss_schedule(self.nepoch, self.warmup).tolist()
+
+        # the whole train split already resides on the device, so batches are
+        # sliced from it by a random permutation instead of going through a loader
+        train_features = self.dataset.data['train_seen']['resnet_features']
+        train_aux = self.dataset.data['train_seen'][self.auxiliary_data_source]
+        # bind attributes used in the inner loop to locals once
+        device = self.device
+        batch_size = self.batch_size
+        ntrain = self.dataset.ntrain
+        trainstep = self.trainstep
+        # a split smaller than one batch is still trained on as a single partial batch
+        num_batches = max(1, ntrain // batch_size)
 
         print('train for reconstruction')
         for epoch in range(0, self.nepoch):
             self.current_epoch = epoch
+            self.current_loss_factors = loss_schedule[epoch]
+            epoch_loss = torch.zeros((), device=device)
 
-            i = -1
-            for iters in range(0, self.dataset.ntrain, self.batch_size):
-                i += 1
-
-                label, data_from_modalities = self.dataset.next_batch(
-                    self.batch_size)
-
-                label = label.long().to(self.device)
-                for j in range(len(data_from_modalities)):
-                    data_from_modalities[j] = data_from_modalities[j].to(
-                        self.device)
-                    data_from_modalities[j].requires_grad = False
-
-                loss = self.trainstep(
-                    data_from_modalities[0], data_from_modalities[1])
+            perm = torch.randperm(ntrain, device=device)
+            for i in range(num_batches):
+                idx = perm[i * batch_size:(i + 1) * batch_size]
+                epoch_loss += trainstep(train_features[idx], train_aux[idx])
 
-                if i % 50 == 0:
-
-                    print('epoch ' + str(epoch) + ' | iter ' + str(i) + '\t' +
-                          ' | loss ' + str(loss)[:5])
-
-                if i % 50 == 0 and i > 0:
-                    losses.append(loss)
+            # single host-device synchronization per epoch
+            epoch_loss = epoch_loss.item() / num_batches
+            print('epoch ' + str(epoch) + ' | iters ' + str(num_batches) + '\t' +
+                  ' | mean loss ' + str(epoch_loss)[:5])
+            losses.append(epoch_loss)
 
         # turn into evaluation mode:
         for key, value in self.encoder.items():
             self.encoder[key].eval()
         for key, value in self.decoder.items():
             self.decoder[key].eval()
+        # deterministic inference: latents are the encoded means
+        self.reparameterize_with_noise = False
 
         return losses
 
+    def zsl_embeddings_cache_path(self):
+        """Path of the cached ZSL embeddings, keyed by the dataset and the weights hash
+        of the auxiliary data encoder, the only network used by predict.
+
+        The hash is computed once per trained state and reset by train_vae.
+        """
+        if self.zsl_embeddings_cache_key is None:
+            digest = hashlib.sha1(self.dataset.dataset.encode())
+            for parameter in self.encoder[self.auxiliary_data_source].parameters():
+                digest.update(parameter.detach().cpu().numpy().tobytes())
+            self.zsl_embeddings_cache_key = digest.hexdigest()[:16]
+        return Path(self.zsl_embeddings_cache_dir) / ('zsl_embeddings_' + self.zsl_embeddings_cache_key + '.pt')
+
     def predict(self):
         """Inference mode for the model
         """
+        # embeddings sampled with noise differ on every call and are never cached
+        use_cache = self.cache_zsl_embeddings and not self.reparameterize_with_noise
+        if use_cache:
+            cache_path = self.zsl_embeddings_cache_path()
+            if cache_path.exists():
+                print('\nLoading cached ZSL embeddings from ' + str(cache_path))
+                return torch.load(cache_path, map_location=self.device)
+
         print('\nComputing ZSL embeddings for test data...')
-        iter_idx = 0
-        embeddings = torch.Tensor()
-        for batch in self.dataset.gen_next_batch(self.batch_size, dset_part='test'):
-            iter_idx += 1
-            label, data_from_modalities = batch
-
-            label = label.long().to(self.device)
-            for j in range(len(data_from_modalities)):
-                data_from_modalities[j] = data_from_modalities[j].to(
-                    self.device)
-            
-            mu_att, logvar_att = self.encoder[self.auxiliary_data_source](data_from_modalities[1])
-            z_from_att = self.reparameterize(mu_att, logvar_att)
-
-            embeddings = torch.cat((embeddings, z_from_att), 0)
-            # embeddings.append(z_from_att)
-        
+        num_samples = self.dataset.data['test_unseen']['labels'].size(0)
+        embeddings = torch.empty((num_samples, self.latent_size), device=self.device)
+        cursor = 0
+        # no autograd bookkeeping is needed for inference
+        with torch.inference_mode():
+            for batch in self.dataset.gen_next_batch(self.batch_size, dset_part='test'):
+                # batches are sliced from tensors that DATA_LOADER keeps on the device
+                label, data_from_modalities = batch
+
+                mu_att, logvar_att = self.encoder[self.auxiliary_data_source](data_from_modalities[1])
+                z_from_att = self.reparameterize(mu_att, logvar_att)
+
+                embeddings[cursor:cursor + z_from_att.size(0)] = z_from_att
+                cursor += z_from_att.size(0)
+
+        if use_cache:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            torch.save(embeddings.cpu(), cache_path)
+
         return embeddings
                 
     # def transfer_features(self, n, num_queries='num_features'):
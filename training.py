@@ -84,7 +84,7 @@ def main():
     #region ZERO-SHOT MODELS TRAINING
     if args.model == 'cada_vae':
         cada_vae_model = CadaVaeModel(config)
-        cada_vae_model.to(config.device)
+        cada_vae_model.to(config.general_parameters.device)
         cada_vae_model.train_vae()
         pass  # TODO: initialize the model with configs
     elif args.model == 'clswgan':